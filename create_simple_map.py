@@ -1,104 +1,32 @@
-import pandas as pd
 import folium
-from folium import plugins
+import mapbuild
 
-# Load plot coordinates
-coords_df = pd.read_csv("figures/plots - Sheet1.csv")
-
-# Parse coordinates
-def parse_coord(coord_str):
-    """Parse 'lon,lat' string into (lon, lat) tuple"""
-    try:
-        parts = coord_str.strip().split(',')
-        return float(parts[0]), float(parts[1])
-    except:
-        return None, None
-
-# Calculate centroid from all 4 coordinates for each plot
-def calculate_centroid(row):
-    """Calculate the centroid (center) of the field from all 4 corner coordinates"""
-    lons = []
-    lats = []
-    for col in ['coordinate1', 'coordinate2', 'coordinate3', 'coordinate4']:
-        if col in row and pd.notna(row[col]):
-            lon, lat = parse_coord(row[col])
-            if lon is not None and lat is not None:
-                lons.append(lon)
-                lats.append(lat)
-    
-    if lons and lats:
-        return pd.Series({'lon': sum(lons) / len(lons), 'lat': sum(lats) / len(lats)})
-    else:
-        return pd.Series({'lon': None, 'lat': None})
+COORDS_FILE = "figures/plots - Sheet1.csv"
+output_file = "field_locations_map.html"
 
-# Get unique plots and calculate centroids
-plot_coords = coords_df.groupby('plot_id').first().reset_index()
-plot_coords[['lon', 'lat']] = plot_coords.apply(calculate_centroid, axis=1)
+# Reuse the previously generated map if the coordinates and this script are unchanged
+cache_file = mapbuild.map_cache_path(output_file, [__file__, COORDS_FILE])
+if mapbuild.restore_cached_map(cache_file, output_file):
+    print(f"Inputs unchanged, reused cached map: {output_file}")
+    exit(0)
 
-# Remove any plots without valid coordinates
-plot_coords = plot_coords.dropna(subset=['lon', 'lat'])
+# Load plot coordinates, one centroid per plot (plots without valid coordinates are dropped)
+plot_coords = mapbuild.load_centroids(COORDS_FILE)
 
 print(f"Found {len(plot_coords)} plots with valid coordinates")
 
-# Calculate center of all plots for map initialization
-center_lat = plot_coords['lat'].mean()
-center_lon = plot_coords['lon'].mean()
-
-# Create folium map with satellite imagery
-m = folium.Map(
-    location=[center_lat, center_lon],
-    zoom_start=15,
-    tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-    attr='Esri World Imagery'
+# Build popups for all plots at once
+plot_coords['popup_html'] = (
+    '<div style="font-family: Arial; min-width: 150px;">'
+    '<h4 style="margin: 5px 0; color: #333;">Plot #' + plot_coords['plot_id'].astype(int).astype(str) + '</h4>'
+    '<hr style="margin: 5px 0;">'
+    '<small>Lat: ' + plot_coords['lat'].map('{:.6f}'.format) + '<br>Lon: ' + plot_coords['lon'].map('{:.6f}'.format) + '</small>'
+    '</div>'
 )
 
-# Add alternative tile layers
-folium.TileLayer('OpenStreetMap', name='Street Map').add_to(m)
-folium.TileLayer(
-    tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-    attr='Esri',
-    name='Satellite',
-    overlay=False,
-    control=True
-).add_to(m)
-
-# Add markers for each plot (simple blue markers)
-for _, row in plot_coords.iterrows():
-    # Create popup with plot information
-    popup_html = f"""
-    <div style="font-family: Arial; min-width: 150px;">
-        <h4 style="margin: 5px 0; color: #333;">Plot #{int(row['plot_id'])}</h4>
-        <hr style="margin: 5px 0;">
-        <small>Lat: {row['lat']:.6f}<br>Lon: {row['lon']:.6f}</small>
-    </div>
-    """
-    
-    # Create circle marker
-    folium.CircleMarker(
-        location=[row['lat'], row['lon']],
-        radius=10,
-        popup=folium.Popup(popup_html, max_width=250),
-        tooltip=f"Plot {int(row['plot_id'])}",
-        color='blue',
-        weight=2,
-        fill=True,
-        fillColor='lightblue',
-        fillOpacity=0.7
-    ).add_to(m)
-    
-    # Add plot number as a label
-    folium.Marker(
-        location=[row['lat'], row['lon']],
-        icon=folium.DivIcon(
-            html=f'''<div style="
-                font-size: 10px; 
-                font-weight: bold; 
-                color: black;
-                text-align: center;
-                text-shadow: 1px 1px 2px white, -1px -1px 2px white;
-                ">{int(row['plot_id'])}</div>'''
-        )
-    ).add_to(m)
+# Create the satellite map centred on all plots and add simple blue markers
+m = mapbuild.make_base_map(plot_coords[['lat', 'lon']].to_numpy().mean(axis=0))
+mapbuild.add_plots_canvas(m, plot_coords, fill_color='lightblue', radius=10, color='blue', fill_opacity=0.7, max_width=250)
 
 # Add title
 title_html = '''
@@ -116,23 +44,10 @@ title_html = '''
 '''
 m.get_root().html.add_child(folium.Element(title_html))
 
-# Add layer control
-folium.LayerControl().add_to(m)
-
-# Add fullscreen button
-plugins.Fullscreen(
-    position='topleft',
-    title='Enter fullscreen mode',
-    title_cancel='Exit fullscreen mode',
-    force_separate_button=True
-).add_to(m)
-
-# Add measure control for distance measurements
-plugins.MeasureControl(position='bottomleft', primary_length_unit='meters').add_to(m)
+mapbuild.add_map_controls(m)
 
 # Save map as HTML
-output_file = "field_locations_map.html"
-m.save(output_file)
+mapbuild.save_map(m, output_file, cache_file)
 
 print(f"\n✅ Map created successfully!")
 print(f"Saved: {output_file}")
@@ -1,11 +1,33 @@
 import os
 import sys
+import argparse
+import glob
+import hashlib
+import re
 import pandas as pd
 import numpy as np
 import matplotlib.dates as mdates
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional; without it the slope windows are computed with NumPy slices, one plot at a time
+    njit = None
+    prange = range
+
 
 REQUIRED_COLS = {'plot_id', 'NDVI', 'SAVI', 'NDWI', 'date'}
+# plot_id stays float64 so clean_and_prepare can check it is integral before casting to int32
+INPUT_DTYPES = {'plot_id': 'float64', 'NDVI': 'float32', 'SAVI': 'float32', 'NDWI': 'float32'}
+CHUNKED_READ_BYTES = 1 << 30  # Inputs larger than this are read and cleaned in chunks
+CHUNK_ROWS = 500_000
+CACHE_DIR = ".cache"
+# Uniform date layouts that can be parsed with one fixed format (month-first, as format='mixed' assumes)
+DATE_FORMATS = [
+    (r'\d{4}-\d{2}-\d{2}', '%Y-%m-%d'),
+    (r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S'),
+    (r'\d{2}/\d{2}/\d{4}', '%m/%d/%Y'),
+]
 
 def find_input_csv():
     """Pick the first .csv in the current folder that contains the required columns."""
@@ -23,46 +45,75 @@ def find_input_csv():
     # Fallback: if none passed the column check, still use the first and let errors surface
     return csvs[0]
 
+def read_input_csv(path: str, header) -> pd.DataFrame:
+    """Read only the required columns, with numeric dtypes set by pyarrow when possible."""
+    # Keep the file's column order (pyarrow returns columns in usecols order)
+    usecols = [col for col in header if str(col) in REQUIRED_COLS]
+    try:
+        # Dates stay strings so every read path parses them the same way in clean_and_prepare
+        return pd.read_csv(path, engine='pyarrow', usecols=usecols,
+                           dtype={**INPUT_DTYPES, 'date': str})
+    except ImportError:
+        print("pyarrow not installed, reading with the default parser.")
+    except ValueError as e:
+        # e.g. repeated header rows or blanks; read as-is and let clean_and_prepare scrub them
+        print(f"Fast typed read failed ({e}), reading with the default parser.")
+    return pd.read_csv(path, usecols=usecols)
+
+def read_and_clean_chunked(path: str, header) -> pd.DataFrame:
+    """Clean a large CSV CHUNK_ROWS rows at a time so only the cleaned rows are ever held together."""
+    usecols = [col for col in header if str(col) in REQUIRED_COLS]
+    chunks = pd.read_csv(path, usecols=usecols, chunksize=CHUNK_ROWS)
+    df = pd.concat([clean_and_prepare(chunk) for chunk in chunks], ignore_index=True)
+    # Each chunk is sorted on its own; restore the global plot/date order
+    return df.sort_values(by=['plot_id', 'date'], kind='stable').reset_index(drop=True)
+
 def clean_and_prepare(df: pd.DataFrame) -> pd.DataFrame:
     # Drop completely empty rows
     df = df.dropna(how='all').copy()
 
     # Remove accidental repeated header rows (e.g., when multiple CSVs were appended)
-    def is_header_like_row(row) -> bool:
-        try:
-            return (
-                str(row.get('date', '')).strip().lower() == 'date' or
-                str(row.get('plot_id', '')).strip().lower() == 'plot_id' or
-                str(row.get('ndvi', '')).strip().lower() == 'ndvi' or
-                str(row.get('savi', '')).strip().lower() == 'savi' or
-                str(row.get('ndwi', '')).strip().lower() == 'ndwi'
-            )
-        except Exception:
-            return False
-
-    header_mask = df.apply(is_header_like_row, axis=1)
+    header_mask = pd.Series(False, index=df.index)
+    for col, literal in {'date': 'date', 'plot_id': 'plot_id', 'NDVI': 'ndvi', 'SAVI': 'savi', 'NDWI': 'ndwi'}.items():
+        if col in df and not pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            header_mask |= df[col].astype(str).str.strip().str.lower().eq(literal)
     if header_mask.any():
         print(f"Removing {int(header_mask.sum())} repeated header-like row(s).")
         df = df.loc[~header_mask].copy()
 
-    # Parse dates robustly
-    date_str = df['date'].astype(str).str.strip()
-    try:
-        # pandas >= 2.0 supports format='mixed'
-        parsed = pd.to_datetime(date_str, errors='coerce', format='mixed')
-    except TypeError:
-        # Fallback for older pandas: let pandas infer; coerce bad ones
-        parsed = pd.to_datetime(date_str, errors='coerce')
-    df['date'] = parsed
+    # Parse dates robustly (skipped when the reader already parsed them)
+    if not pd.api.types.is_datetime64_any_dtype(df['date']):
+        date_str = df['date'].astype(str).str.strip()
+        parsed = None
+        # Fast path: if a sample of dates all share one known layout, parse with that fixed format
+        sample = date_str[df['date'].notna()].head(100)
+        for pattern, fmt in DATE_FORMATS:
+            if len(sample) and all(re.fullmatch(pattern, d) for d in sample):
+                parsed = pd.to_datetime(date_str, errors='coerce', format=fmt)
+                break
+        if parsed is None or parsed.isna().any():
+            # Mixed layouts (or rows the fixed format missed): parse those flexibly
+            todo = date_str if parsed is None else date_str[parsed.isna()]
+            try:
+                # pandas >= 2.0 supports format='mixed'
+                flexible = pd.to_datetime(todo, errors='coerce', format='mixed')
+            except TypeError:
+                # Fallback for older pandas: let pandas infer; coerce bad ones
+                flexible = pd.to_datetime(todo, errors='coerce')
+            parsed = flexible if parsed is None else parsed.fillna(flexible)
+        df['date'] = parsed
 
     bad_dates = df['date'].isna().sum()
     if bad_dates:
         print(f"Dropping {bad_dates} row(s) with invalid dates.")
         df = df.dropna(subset=['date']).copy()
 
-    # Ensure numeric columns are numeric
-    for col in ['plot_id', 'NDVI', 'SAVI', 'NDWI']:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Ensure numeric columns are numeric (already true after a typed pyarrow read)
+    num_cols = ['plot_id', 'NDVI', 'SAVI', 'NDWI']
+    if not df[num_cols].dtypes.apply(pd.api.types.is_numeric_dtype).all():
+        df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce')
+    # float32 is ample for index values and halves memory traffic
+    df[num_cols[1:]] = df[num_cols[1:]].astype(np.float32)
 
     # Drop rows with missing required numeric values
     before = len(df)
@@ -74,108 +125,222 @@ def clean_and_prepare(df: pd.DataFrame) -> pd.DataFrame:
     # Sort for time-diff calculations
     df = df.sort_values(by=['plot_id', 'date']).reset_index(drop=True)
 
-    # Optionally cast plot_id to int if it's integral
-    if np.all(np.mod(df['plot_id'], 1) == 0):
-        df['plot_id'] = df['plot_id'].astype(int)
+    # Optionally cast plot_id to int32 if it's integral (no data pass needed for integer dtypes)
+    pid = df['plot_id']
+    if pd.api.types.is_integer_dtype(pid):
+        df['plot_id'] = pid.astype(np.int32)
+    elif np.isfinite(pid).all() and np.all(pid == pid.astype(np.int64)):
+        df['plot_id'] = pid.astype(np.int32)
 
     return df
 
-def calculate_slope(group: pd.DataFrame, column_name: str, window_days=16) -> pd.Series:
+def _window_slopes_numpy(days, values, half_window):
+    """Median pairwise slope within ±half_window days of each observation, for every column of values (days sorted)."""
+    # Rows are sorted by date, so every temporal window is a contiguous slice [lo, hi)
+    lo = np.searchsorted(days, days - half_window, side='left')
+    hi = np.searchsorted(days, days + half_window, side='right')
+    
+    slopes = np.zeros(values.shape)
+    for i in range(len(days)):
+        window_dates = days[lo[i]:hi[i]]
+        window_values = values[lo[i]:hi[i]]
+        
+        # Calculate pairwise slopes within the window and take median
+        # This is more robust than simple linear regression
+        # The date differences are shared by all index columns, so they are built once per window
+        time_diff = window_dates[None, :] - window_dates[:, None]
+        later = time_diff > 0  # each pair once, skipping same-day observations
+        if later.any():
+            value_diff = window_values[None, :, :] - window_values[:, None, :]
+            # Use median of all pairwise slopes (very robust!)
+            slopes[i] = np.median(value_diff[later] / time_diff[later][:, None], axis=0)
+    
+    return slopes
+
+def _window_slopes_scan(days, values, half_window):
+    """Same as _window_slopes_numpy, as a two-pointer scan with a reused scratch buffer (for numba)."""
+    n, n_cols = values.shape
+    slopes = np.zeros((n, n_cols))
+    scratch = np.empty((n_cols, 0))
+    lo = 0
+    hi = 0
+    for i in range(n):
+        # Slide the window [lo, hi) forward; both pointers only ever advance
+        while hi < n and days[hi] <= days[i] + half_window:
+            hi += 1
+        while days[lo] < days[i] - half_window:
+            lo += 1
+        
+        width = hi - lo
+        if width * (width - 1) // 2 > scratch.shape[1]:
+            scratch = np.empty((n_cols, width * (width - 1) // 2))
+        
+        count = 0
+        for j in range(lo, hi):
+            for k in range(j + 1, hi):
+                time_diff = days[k] - days[j]
+                if time_diff > 0:
+                    for c in range(n_cols):
+                        scratch[c, count] = (values[k, c] - values[j, c]) / time_diff
+                    count += 1
+        if count > 0:
+            for c in range(n_cols):
+                slopes[i, c] = np.median(scratch[c, :count])
+    
+    return slopes
+
+def _all_window_slopes(days, values, starts, ends, half_window, out):
+    """Fill out with the window slopes of every plot block [starts[g], ends[g]); plots run in parallel under numba."""
+    for g in prange(len(starts)):
+        start = starts[g]
+        end = ends[g]
+        out[start:end] = _window_slopes(days[start:end], values[start:end], half_window)
+
+if njit is not None:
+    _window_slopes = njit(cache=True)(_window_slopes_scan)
+    # Thread count follows numba's default (all cores) or the NUMBA_NUM_THREADS environment variable
+    _all_window_slopes = njit(parallel=True, cache=True)(_all_window_slopes)
+else:
+    _window_slopes = _window_slopes_numpy
+
+def calculate_slopes(df: pd.DataFrame, column_names, window_days=16) -> dict:
     """
     Calculate slope using a TEMPORAL 16-day window.
     For each observation, considers all points within ±8 days and computes median slope.
     This provides very smooth, stable slope estimates for phenology classification.
     
     Args:
-        group: DataFrame for a single plot
-        column_name: Name of the vegetation index column
+        df: DataFrame sorted by plot_id then date (each plot is one contiguous block)
+        column_names: Names of the vegetation index columns
         window_days: Temporal window in days (default 16)
-    """
-    slopes = []
-    dates = group['date'].values
-    values = group[column_name].values
     
+    Returns:
+        {column_name: slope array aligned with the rows of df}
+    """
+    days = df['date'].values.astype('datetime64[D]').view(np.int64)
     half_window = window_days / 2  # ±8 days from center point
     
-    for i in range(len(group)):
-        current_date = dates[i]
-        
-        # Find all points within the temporal window
-        time_diffs_days = np.abs((dates - current_date).astype('timedelta64[D]').astype(float))
-        within_window = time_diffs_days <= half_window
-        
-        # Need at least 2 points to calculate slope
-        if within_window.sum() < 2:
-            slopes.append(0)
-            continue
-        
-        # Get points within window
-        window_dates = dates[within_window]
-        window_values = values[within_window]
-        
-        # Calculate pairwise slopes within the window and take median
-        # This is more robust than simple linear regression
-        pairwise_slopes = []
-        for j in range(len(window_dates)):
-            for k in range(j + 1, len(window_dates)):
-                time_diff = (window_dates[k] - window_dates[j]).astype('timedelta64[D]').astype(float)
-                if time_diff > 0:
-                    value_diff = window_values[k] - window_values[j]
-                    pairwise_slopes.append(value_diff / time_diff)
-        
-        if pairwise_slopes:
-            # Use median of all pairwise slopes (very robust!)
-            slopes.append(np.median(pairwise_slopes))
-        else:
-            slopes.append(0)
+    # Block boundaries where plot_id changes, in one pass instead of a groupby per column
+    plot_ids = df['plot_id'].to_numpy()
+    starts = np.r_[0, np.flatnonzero(plot_ids[1:] != plot_ids[:-1]) + 1]
+    ends = np.r_[starts[1:], len(df)]
+    
+    # All columns go through each plot's windows together, so the date work is done once
+    values = df[list(column_names)].to_numpy(dtype=float)
+    out = np.empty(values.shape, dtype=np.float32, order='F')
+    _all_window_slopes(days, values, starts, ends, half_window, out)
+    out = np.nan_to_num(out, nan=0.0, posinf=0.0, neginf=0.0)
     
-    return pd.Series(slopes, index=group.index).fillna(0).replace([np.inf, -np.inf], 0)
+    slopes = {column_name: out[:, c] for c, column_name in enumerate(column_names)}
+    return slopes
 
-def main():
-    print("Starting data processing...")
+def load_and_clean(input_file_path: str) -> pd.DataFrame:
+    """Validate the header, then read and clean the input CSV (exits on failure)."""
+    # Validate columns from the header before reading the full file
     try:
-        input_file_path = find_input_csv()
-        print(f"Using input file: {input_file_path}")
+        header = pd.read_csv(input_file_path, nrows=0).columns
     except Exception as e:
-        print(f"Error selecting input CSV: {e}")
+        print(f"Failed to read '{input_file_path}': {e}")
+        sys.exit(1)
+    missing = REQUIRED_COLS - set(map(str, header))
+    if missing:
+        print(f"Input file is missing required columns: {missing}")
         sys.exit(1)
 
-    # Load full CSV now that we chose one
+    # Load & clean the full CSV now that we chose one (chunk by chunk when it is very large)
     try:
-        df = pd.read_csv(input_file_path)
+        if os.path.getsize(input_file_path) > CHUNKED_READ_BYTES:
+            print(f"Large input, reading in chunks of {CHUNK_ROWS} rows...")
+            df = read_and_clean_chunked(input_file_path, header)
+        else:
+            df = clean_and_prepare(read_input_csv(input_file_path, header))
     except Exception as e:
         print(f"Failed to read '{input_file_path}': {e}")
         sys.exit(1)
+    return df
 
-    # Validate columns
-    missing = REQUIRED_COLS - set(map(str, df.columns))
-    if missing:
-        print(f"Input file is missing required columns: {missing}")
+def clean_cache_path(input_file_path: str) -> str:
+    """Parquet cache file for the cleaned rows of this input, keyed on its path, mtime and size."""
+    # One name prefix per input path, so a new entry can replace the stale ones for the same file;
+    # this script's own mtime is part of the key so changes to the cleaning rules invalidate it
+    path_key = hashlib.sha1(os.path.abspath(input_file_path).encode()).hexdigest()[:8]
+    key = hashlib.sha1(
+        f"{os.path.getmtime(input_file_path)}-{os.path.getsize(input_file_path)}-"
+        f"{os.path.getmtime(__file__)}".encode()
+    ).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"clean_{path_key}_{key}.parquet")
+
+def read_clean_cache(cache_file: str):
+    """Cleaned DataFrame from an earlier run, or None if there is no usable cache."""
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        return pd.read_parquet(cache_file)
+    except Exception:
+        # pyarrow missing or a damaged file; just clean from scratch
+        return None
+
+def write_clean_cache(df: pd.DataFrame, cache_file: str):
+    """Store the cleaned DataFrame for later runs, replacing older entries for the same input (skipped silently without pyarrow)."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(cache_file, index=False)
+        prefix = os.path.basename(cache_file).rsplit('_', 1)[0] + '_'
+        for old_file in glob.glob(os.path.join(CACHE_DIR, glob.escape(prefix) + '*.parquet')):
+            if old_file != cache_file:
+                os.remove(old_file)
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"Could not write cache '{cache_file}': {e}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute slopes and four-stage phenology for the input CSV.")
+    parser.add_argument('--verbose', action='store_true',
+                        help="print every plot's stage transitions (default: only on a terminal or with VERBOSE set)")
+    # Only command-line runs pass argv; a notebook or another script calling main() must not pick up its sys.argv
+    args = parser.parse_args([] if argv is None else argv)
+    verbose = args.verbose or sys.stdout.isatty() or bool(os.environ.get('VERBOSE'))
+
+    print("Starting data processing...")
+    try:
+        input_file_path = find_input_csv()
+        print(f"Using input file: {input_file_path}")
+    except Exception as e:
+        print(f"Error selecting input CSV: {e}")
         sys.exit(1)
 
-    # Clean & prepare
-    df = clean_and_prepare(df)
+    # Reuse the cleaned rows from an earlier run on the same, unchanged input
+    cache_file = clean_cache_path(input_file_path)
+    df = read_clean_cache(cache_file)
+    if df is None:
+        df = load_and_clean(input_file_path)
+        write_clean_cache(df, cache_file)
+    else:
+        print(f"Loaded cleaned data from cache: {cache_file}")
     print("Data loading and cleaning complete.")
     print(f"Rows after cleaning: {len(df)}")
 
+    # Rows are sorted by plot, so a categorical plot_id lets every groupby work on its codes
+    df['plot_id'] = pd.Categorical(df['plot_id'], categories=df['plot_id'].unique(), ordered=True)
+
     # Compute slopes
     print("Calculating slopes for NDVI, SAVI, and NDWI...")
-    grouped = df.groupby('plot_id', group_keys=False)
-
-    df['NDVI_slope'] = grouped.apply(lambda g: calculate_slope(g, 'NDVI'), include_groups=False)
-    df['SAVI_slope'] = grouped.apply(lambda g: calculate_slope(g, 'SAVI'), include_groups=False)
-    df['NDWI_slope'] = grouped.apply(lambda g: calculate_slope(g, 'NDWI'), include_groups=False)
+    slopes = calculate_slopes(df, ['NDVI', 'SAVI', 'NDWI'])
+    df['NDVI_slope'] = slopes['NDVI']
+    df['SAVI_slope'] = slopes['SAVI']
+    df['NDWI_slope'] = slopes['NDWI']
     print("Slope calculation finished.")
     # --- Rule-based phenology classification --------------------------------------
     # --- Four-stage phenology classification (Seedling, Tillering, Growth, Ripening) ---
     from typing import Dict
 
-    def add_four_stage_classification(df: pd.DataFrame, params: Dict = None) -> pd.DataFrame:
+    def add_four_stage_classification(df: pd.DataFrame, params: Dict = None, verbose: bool = True) -> pd.DataFrame:
         """
         Crop phenology classification based on greenness and slope trends.
         Thresholds are DATA-DRIVEN from field observations (percentiles of actual measurements).
         
-        Adds:
+        Adds (in place, df is also returned):
           - G (0.6*NDVI + 0.4*SAVI): Combined greenness index
           - W (=NDWI): Water content index
           - sG (avg slope of NDVI & SAVI): Rate of greenness change
@@ -216,28 +381,27 @@ def main():
                 "roll_window": 3,
             }
 
-        out = df.copy()
-
         # Features
-        out["G"] = 0.6 * out["NDVI"] + 0.4 * out["SAVI"]
-        out["W"] = out["NDWI"]
-        out["sG"] = 0.5 * (out["NDVI_slope"] + out["SAVI_slope"])
-
-        # Smooth per plot (rolling median)
-        def _smooth(g):
-            w = params["roll_window"]
-            g = g.sort_values("date")
-            g["G_sm"] = g["G"].rolling(w, center=True, min_periods=1).median()
-            g["sG_sm"] = g["sG"].rolling(w, center=True, min_periods=1).median()
-            g["W_sm"] = g["W"].rolling(w, center=True, min_periods=1).median()
-            return g
-
-        out = out.groupby("plot_id", group_keys=False).apply(_smooth)
+        ndvi = df["NDVI"].to_numpy(np.float32, copy=False)
+        savi = df["SAVI"].to_numpy(np.float32, copy=False)
+        df["G"] = 0.6 * ndvi + 0.4 * savi
+        df["W"] = df["NDWI"].to_numpy(np.float32, copy=False)
+        df["sG"] = 0.5 * (df["NDVI_slope"].to_numpy(np.float32, copy=False)
+                          + df["SAVI_slope"].to_numpy(np.float32, copy=False))
+
+        # Smooth per plot (rolling median); rows are already sorted by plot_id then date
+        smoothed = (
+            df.groupby("plot_id", sort=False, observed=True)[["G", "sG", "W"]]
+            .rolling(params["roll_window"], center=True, min_periods=1)
+            .median()
+            .reset_index(level=0, drop=True)
+        )
+        df[["G_sm", "sG_sm", "W_sm"]] = smoothed[["G", "sG", "W"]]
 
         P = params
-        G = out["G_sm"]
-        sG = out["sG_sm"]
-        W = out["W_sm"]
+        G = df["G_sm"]
+        sG = df["sG_sm"]
+        W = df["W_sm"]
 
         # Helper masks
         rising_str = sG >= P["rise_strong"]
@@ -246,73 +410,61 @@ def main():
         falling_weak = (sG <= P["fall_weak"]) & (sG > P["fall_strong"])
         falling_str = sG <= P["fall_strong"]
 
-        stage = np.empty(len(out), dtype=object)
-        code = np.empty(len(out), dtype=int)
-        stage[:] = "Bare"  # default fallback for uncategorized (likely bare/fallow fields)
-        code[:] = 0  # 0 = Bare/No-Crop
-
         # Classification in priority order (later rules override earlier ones only when appropriate)
         
         # 1. RIPENING: Any falling trend (must check first to avoid conflicts)
         #    - Crop senescence/maturation phase
-        m = (falling_weak | falling_str)
-        stage[m] = "Ripening"
-        code[m] = 4
+        ripening = falling_weak | falling_str
 
         # 2. GROWTH: High greenness with rising or stable trend (peak vegetative growth)
         #    - Requires rising/flat trend to distinguish from bare fields at plateau
-        m = (G >= P["G_high"]) & (rising_str | rising_weak | flatish)
-        stage[m] = "Growth"
-        code[m] = 3
+        growth = (G >= P["G_high"]) & (rising_str | rising_weak | flatish)
 
         # 3. TILLERING: Mid-range greenness with ACTIVE rising trend (establishment phase)
         #    - Must be BELOW Growth threshold to avoid overlap
         #    - Requires rising slope to avoid classifying static bare fields
-        m = (G >= P["G_seed_max"]) & (G < P["G_high"]) & (rising_str | rising_weak)
-        stage[m] = "Tillering"
-        code[m] = 2
+        tillering = (G >= P["G_seed_max"]) & (G < P["G_high"]) & (rising_str | rising_weak)
         
         # 3b. TILLERING (plateau): Mid greenness that's flat but came from rising
         #     - Allow flat slope ONLY if greenness is reasonably high (>0.35)
-        m = (G >= 0.35) & (G < P["G_high"]) & flatish
-        stage[m] = "Tillering"
-        code[m] = 2
+        tillering_plateau = (G >= 0.35) & (G < P["G_high"]) & flatish
 
         # 4. SEEDLING: Low greenness with rising trend (early establishment)
         #    - MUST have rising slope to distinguish from bare soil
-        m = (G < P["G_seed_max"]) & (rising_str | rising_weak)
-        stage[m] = "Seedling"
-        code[m] = 1
+        seedling = (G < P["G_seed_max"]) & (rising_str | rising_weak)
 
         # 5. SEEDLING (water override): Very wet conditions with low greenness (transplanted/flooded)
         #    - Special case for flooded/transplanted fields
-        m = (W >= P["W_water"]) & (G < 0.35)
-        stage[m] = "Seedling"
-        code[m] = 1
+        seedling_water = (W >= P["W_water"]) & (G < 0.35)
         
         # 6. Handle ambiguous low greenness with flat/falling trend in early season
         #    If greenness is very low and flat (not rising), likely still establishing
-        m = (G < P["G_seed_max"]) & flatish & (stage == "Growth")  # Only override default
-        stage[m] = "Seedling"
-        code[m] = 1
-
-        out["stage_4"] = stage
-        out["stage4_code"] = code
-
-        # (Optional) print stage transitions per plot
-        def _transitions(g):
-            g = g.sort_values("date")
-            pid = g["plot_id"].iloc[0]
-            runs = (g["stage_4"] != g["stage_4"].shift()).fillna(True)
-            for d, s in zip(g.loc[runs, "date"], g.loc[runs, "stage_4"]):
+        #    (only where rules 1-5 left the row as Growth)
+        seedling_flat = (G < P["G_seed_max"]) & flatish & growth & ~(tillering | tillering_plateau)
+
+        # np.select takes the FIRST matching condition, so pass the rules last-to-first;
+        # rows matching none stay 0 = Bare/No-Crop (likely bare/fallow fields)
+        code = np.select(
+            [seedling_flat, seedling_water, seedling, tillering_plateau, tillering, growth, ripening],
+            [1, 1, 1, 2, 2, 3, 4],
+            default=0,
+        ).astype(np.int8)
+
+        # stage4_code is the source of truth; stage_4 is a categorical view over the same int8 codes
+        df["stage_4"] = pd.Categorical.from_codes(code, categories=["Bare", "Seedling", "Tillering", "Growth", "Ripening"])
+        df["stage4_code"] = code
+
+        # (Optional) print stage transitions per plot; rows are plot/date sorted, so a
+        # transition is any row whose plot or stage differs from the previous row
+        if verbose:
+            chg = df["plot_id"].ne(df["plot_id"].shift()) | df["stage_4"].ne(df["stage_4"].shift())
+            for pid, d, s in df.loc[chg, ["plot_id", "date", "stage_4"]].itertuples(index=False):
                 print(f"plot {pid}: {d.date()} → {s}")
-            return g
 
-        out = out.groupby("plot_id", group_keys=False).apply(_transitions)
-        return out
+        return df
 
     # Apply 4-stage classification (replace previous add_phenology_classification call)
-    df = add_four_stage_classification(df)
+    df = add_four_stage_classification(df, verbose=verbose)
 
     # (Optional) Save first occurrence of each stage per plot
     summary4 = (
@@ -324,12 +476,19 @@ def main():
     summary4.to_csv("phenology_stage4_transitions.csv", index=False)
     print("Saved: phenology_stage4_transitions.csv")
 
-    # Save
+    # Save (OUTPUT_FORMAT=parquet writes a smaller, faster Parquet file instead of the CSV)
     output_file_path = 'plot_data_with_slopes.csv'
     try:
-        df.to_csv(output_file_path, index=False)
+        if os.environ.get('OUTPUT_FORMAT', 'csv').lower() == 'parquet':
+            try:
+                df.to_parquet('plot_data_with_slopes.parquet', engine='pyarrow', compression='zstd', index=False)
+                output_file_path = 'plot_data_with_slopes.parquet'
+            except ImportError:
+                print("pyarrow not installed, writing CSV instead.")
+        if output_file_path.endswith('.csv'):
+            df.to_csv(output_file_path, index=False, chunksize=100_000, float_format='%.6g')
     except Exception as e:
-        print(f"Failed to write output CSV: {e}")
+        print(f"Failed to write output file '{output_file_path}': {e}")
         sys.exit(1)
 
     # Small summary
@@ -416,31 +575,15 @@ def visualize_phenology_classification(df, plot_id, outdir="figures"):
     
     # Add colored background regions for each stage
     if 'stage_4' in plot_data.columns:
-        current_stage = None
-        start_idx = 0
-        
-        for idx in range(len(plot_data)):
-            stage = plot_data.iloc[idx]['stage_4']
-            
-            if stage != current_stage:
-                # When stage changes, fill the previous region
-                if current_stage is not None and start_idx < idx:
-                    color = stage_colors.get(current_stage, '#CCCCCC')
-                    for ax in axes:
-                        ax.axvspan(plot_data.iloc[start_idx]['date'], 
-                                  plot_data.iloc[idx]['date'],
-                                  alpha=0.2, color=color, zorder=0)
-                
-                current_stage = stage
-                start_idx = idx
-        
-        # Fill the last region
-        if current_stage is not None and start_idx < len(plot_data):
-            color = stage_colors.get(current_stage, '#CCCCCC')
+        stages = plot_data['stage_4'].to_numpy()
+        dts = plot_data['date'].to_numpy()
+        # A new stage region starts wherever the stage differs from the previous row
+        starts = np.r_[0, np.flatnonzero(stages[1:] != stages[:-1]) + 1]
+        ends = np.r_[starts[1:], len(stages) - 1]
+        for start, end in zip(starts, ends):
+            color = stage_colors.get(stages[start], '#CCCCCC')
             for ax in axes:
-                ax.axvspan(plot_data.iloc[start_idx]['date'], 
-                          plot_data.iloc[-1]['date'],
-                          alpha=0.2, color=color, zorder=0)
+                ax.axvspan(dts[start], dts[end], alpha=0.2, color=color, zorder=0)
     
     ax3.set_title('Phenology Stage Classification', fontsize=12, fontweight='bold')
     ax3.grid(True, alpha=0.3)
@@ -449,17 +592,12 @@ def visualize_phenology_classification(df, plot_id, outdir="figures"):
     # Detect dates where phenology class changes
     transition_dates = []
     if 'stage_4' in plot_data.columns and len(plot_data) > 0:
-        # Add first date
-        transition_dates.append(plot_data.iloc[0]['date'])
-        
-        # Find all dates where stage changes
-        for idx in range(1, len(plot_data)):
-            if plot_data.iloc[idx]['stage_4'] != plot_data.iloc[idx-1]['stage_4']:
-                transition_dates.append(plot_data.iloc[idx]['date'])
+        # First date plus every date where the stage changes (the region starts above)
+        transition_dates = list(dts[starts])
         
         # Add last date
-        if plot_data.iloc[-1]['date'] not in transition_dates:
-            transition_dates.append(plot_data.iloc[-1]['date'])
+        if dts[-1] not in transition_dates:
+            transition_dates.append(dts[-1])
     else:
         # Fallback: use all dates if stage_4 not available
         transition_dates = plot_data['date'].tolist()
@@ -688,37 +826,20 @@ def plot_classification_comparison(df, plot_ids=(1, 2), outdir="figures"):
         
         # Add colored background regions
         if 'stage_4' in plot_data.columns:
-            current_stage = None
-            start_idx = 0
-            
-            for i in range(len(plot_data)):
-                stage = plot_data.iloc[i]['stage_4']
-                
-                if stage != current_stage:
-                    if current_stage is not None and start_idx < i:
-                        color = stage_colors.get(current_stage, '#CCCCCC')
-                        ax.axvspan(plot_data.iloc[start_idx]['date'], 
-                                  plot_data.iloc[i]['date'],
-                                  alpha=0.3, color=color, zorder=0)
-                    current_stage = stage
-                    start_idx = i
-            
-            # Fill the last region
-            if current_stage is not None and start_idx < len(plot_data):
-                color = stage_colors.get(current_stage, '#CCCCCC')
-                ax.axvspan(plot_data.iloc[start_idx]['date'], 
-                          plot_data.iloc[-1]['date'],
-                          alpha=0.3, color=color, zorder=0)
+            stages = plot_data['stage_4'].to_numpy()
+            dts = plot_data['date'].to_numpy()
+            starts = np.r_[0, np.flatnonzero(stages[1:] != stages[:-1]) + 1]
+            ends = np.r_[starts[1:], len(stages) - 1]
+            for start, end in zip(starts, ends):
+                color = stage_colors.get(stages[start], '#CCCCCC')
+                ax.axvspan(dts[start], dts[end], alpha=0.3, color=color, zorder=0)
         
         # Detect transition dates for x-axis
         transition_dates = []
         if 'stage_4' in plot_data.columns and len(plot_data) > 0:
-            transition_dates.append(plot_data.iloc[0]['date'])
-            for i in range(1, len(plot_data)):
-                if plot_data.iloc[i]['stage_4'] != plot_data.iloc[i-1]['stage_4']:
-                    transition_dates.append(plot_data.iloc[i]['date'])
-            if plot_data.iloc[-1]['date'] not in transition_dates:
-                transition_dates.append(plot_data.iloc[-1]['date'])
+            transition_dates = list(dts[starts])
+            if dts[-1] not in transition_dates:
+                transition_dates.append(dts[-1])
         
         # Format plot
         ax.set_title(f'Plot {pid} - Phenology Classification', fontsize=13, fontweight='bold')
@@ -759,7 +880,7 @@ def plot_classification_map(df: pd.DataFrame, target_date: str, max_plots: int =
         outdir: Output directory for the HTML map file
     """
     import folium
-    from folium import plugins
+    import mapbuild
     
     # Load plot coordinates
     try:
@@ -768,177 +889,38 @@ def plot_classification_map(df: pd.DataFrame, target_date: str, max_plots: int =
         print("Warning: Plot coordinates file not found. Cannot create map.")
         return
     
-    # Parse coordinates and get unique plots
-    def parse_coord(coord_str):
-        """Parse 'lon,lat' string into (lon, lat) tuple"""
-        try:
-            parts = coord_str.strip().split(',')
-            return float(parts[0]), float(parts[1])
-        except:
-            return None, None
-    
-    # Calculate centroid from all 4 coordinates for each plot
-    def calculate_centroid(row):
-        """Calculate the centroid (center) of the field from all 4 corner coordinates"""
-        lons = []
-        lats = []
-        for col in ['coordinate1', 'coordinate2', 'coordinate3', 'coordinate4']:
-            if col in row and pd.notna(row[col]):
-                lon, lat = parse_coord(row[col])
-                if lon is not None and lat is not None:
-                    lons.append(lon)
-                    lats.append(lat)
-        
-        if lons and lats:
-            return pd.Series({'lon': sum(lons) / len(lons), 'lat': sum(lats) / len(lats)})
-        else:
-            return pd.Series({'lon': None, 'lat': None})
+    # Keep only the first max_plots plots before any parsing work
+    coords_df = coords_df[coords_df['plot_id'] <= max_plots]
     
     # Get unique plots and calculate centroids
-    plot_coords = coords_df.groupby('plot_id').first().reset_index()
-    plot_coords[['lon', 'lat']] = plot_coords.apply(calculate_centroid, axis=1)
-    
-    # Filter to first max_plots
-    plot_coords = plot_coords[plot_coords['plot_id'] <= max_plots].copy()
+    plot_coords = coords_df.drop_duplicates(subset='plot_id', keep='first').copy()
+    plot_coords[['lon', 'lat']] = mapbuild.calculate_centroids(plot_coords)
     
     # Filter data to target date and merge with coordinates
     target_df = df[df['date'] == target_date].copy()
     
     # Get one observation per plot (take first if multiple)
-    target_df = target_df.groupby('plot_id').first().reset_index()
+    target_df = target_df.drop_duplicates(subset='plot_id', keep='first')
     
-    # Merge with coordinates
+    # Merge with coordinates, keeping only plots with data on the target date
     map_data = plot_coords.merge(target_df[['plot_id', 'stage4_code', 'stage_4', 'NDVI', 'SAVI', 'NDWI']], 
-                                   on='plot_id', how='left')
-    
-    # Remove plots without data
-    map_data = map_data.dropna(subset=['stage4_code'])
-    
-    # Define phenology stage colors (matching other visualizations)
-    stage_colors = {
-        0: '#D3D3D3',      # Bare - light gray
-        1: '#90EE90',      # Seedling - light green
-        2: '#FFD700',      # Tillering - gold
-        3: '#228B22',      # Growth - forest green
-        4: '#FF8C00'       # Ripening - dark orange
-    }
-    
-    stage_names = {
-        0: 'Bare',
-        1: 'Seedling',
-        2: 'Tillering',
-        3: 'Growth',
-        4: 'Ripening'
-    }
+                                   on='plot_id', how='inner')
     
-    # Calculate center of all plots for map initialization
-    center_lat = map_data['lat'].mean()
-    center_lon = map_data['lon'].mean()
+    # Create folium map with satellite imagery, centred on all plots
+    m = mapbuild.make_base_map(map_data[['lat', 'lon']].to_numpy().mean(axis=0))
     
-    # Create folium map with satellite imagery
-    m = folium.Map(
-        location=[center_lat, center_lon],
-        zoom_start=15,
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri World Imagery'
-    )
+    # Marker color and popup with detailed information for every plot at once
+    map_data = mapbuild.with_stage_columns(map_data)
+    map_data['popup_html'] = mapbuild.stage_popup_html(map_data, target_date)
     
-    # Add alternative tile layers
-    folium.TileLayer('OpenStreetMap', name='Street Map').add_to(m)
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Satellite',
-        overlay=False,
-        control=True
-    ).add_to(m)
-    
-    # Add markers for each plot
-    for _, row in map_data.iterrows():
-        stage = int(row['stage4_code'])
-        color = stage_colors.get(stage, '#808080')
-        stage_name = stage_names.get(stage, 'Unknown')
-        
-        # Create popup with detailed information
-        popup_html = f"""
-        <div style="font-family: Arial; min-width: 200px;">
-            <h4 style="margin: 5px 0; color: #333;">Plot #{int(row['plot_id'])}</h4>
-            <hr style="margin: 5px 0;">
-            <b>Date:</b> {target_date}<br>
-            <b>Phenology Stage:</b> <span style="color: {color}; font-weight: bold;">{stage_name}</span> (Stage {stage})<br>
-            <hr style="margin: 5px 0;">
-            <b>Vegetation Indices:</b><br>
-            • NDVI: {row['NDVI']:.4f}<br>
-            • SAVI: {row['SAVI']:.4f}<br>
-            • NDWI: {row['NDWI']:.4f}<br>
-            <hr style="margin: 5px 0;">
-            <small>Lat: {row['lat']:.6f}, Lon: {row['lon']:.6f}</small>
-        </div>
-        """
-        
-        # Create circle marker with custom styling
-        folium.CircleMarker(
-            location=[row['lat'], row['lon']],
-            radius=12,
-            popup=folium.Popup(popup_html, max_width=300),
-            tooltip=f"Plot {int(row['plot_id'])}: {stage_name}",
-            color='black',
-            weight=2,
-            fill=True,
-            fillColor=color,
-            fillOpacity=0.8
-        ).add_to(m)
-        
-        # Add plot number as a label
-        folium.Marker(
-            location=[row['lat'], row['lon']],
-            icon=folium.DivIcon(
-                html=f'''<div style="
-                    font-size: 10px; 
-                    font-weight: bold; 
-                    color: black;
-                    text-align: center;
-                    text-shadow: 1px 1px 2px white, -1px -1px 2px white;
-                    ">{int(row['plot_id'])}</div>'''
-            )
-        ).add_to(m)
+    # Add all plots as one batch of circle markers labelled with their plot number
+    mapbuild.add_plots_canvas(m, map_data, color_col='color', radius=12, color='black', fill_opacity=0.8, max_width=300)
     
     # Add custom legend
-    legend_html = f'''
-    <div style="position: fixed; 
-                top: 10px; right: 10px; width: 220px; 
-                background-color: white; 
-                border:2px solid grey; z-index:9999; 
-                font-size:14px;
-                padding: 10px;
-                border-radius: 5px;
-                box-shadow: 2px 2px 6px rgba(0,0,0,0.3);">
-        <h4 style="margin-top:0; margin-bottom:10px; text-align:center;">Phenology Stages</h4>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[0]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 0: Bare</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[1]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 1: Seedling</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[2]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 2: Tillering</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[3]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 3: Growth</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[4]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 4: Ripening</p>
-        <hr style="margin: 10px 0;">
-        <p style="margin: 5px 0; font-size: 12px; text-align: center;"><b>Date:</b> {target_date}</p>
-        <p style="margin: 5px 0; font-size: 12px; text-align: center;"><b>Plots:</b> {len(map_data)}</p>
-    </div>
-    '''
+    legend_html = mapbuild.stage_legend_html(target_date, 'Plots', len(map_data))
     m.get_root().html.add_child(folium.Element(legend_html))
     
-    # Add layer control
-    folium.LayerControl().add_to(m)
-    
-    # Add fullscreen button
-    plugins.Fullscreen(
-        position='topleft',
-        title='Enter fullscreen mode',
-        title_cancel='Exit fullscreen mode',
-        force_separate_button=True
-    ).add_to(m)
-    
-    # Add measure control for distance measurements
-    plugins.MeasureControl(position='bottomleft', primary_length_unit='meters').add_to(m)
+    mapbuild.add_map_controls(m)
     
     # Save map as HTML
     os.makedirs(outdir, exist_ok=True)
@@ -952,7 +934,7 @@ def plot_classification_map(df: pd.DataFrame, target_date: str, max_plots: int =
 
 
 if __name__ == "__main__":
-    df = main()  # Capture the returned DataFrame
+    df = main(sys.argv[1:])  # Capture the returned DataFrame
 
     # Only visualize plots 1 and 2 (Green and Blue fields)
     plot_ids_to_viz = [1, 2]
@@ -966,12 +948,9 @@ if __name__ == "__main__":
     try:
         plot_slopes_for_plots(df, plot_ids=tuple(plot_ids_to_viz), outdir="figures")
     except NameError:
-        # If df is not in scope (e.g., you moved code), load from CSV:
-        df = pd.read_csv("plot_data_with_slopes.csv")
-        try:
-            df['date'] = pd.to_datetime(df['date'], errors='coerce', format='mixed')
-        except TypeError:
-            df['date'] = pd.to_datetime(df['date'], errors='coerce')
+        # If df is not in scope (e.g., you moved code), load the saved output (CSV or Parquet):
+        import mapbuild
+        df = mapbuild.read_plot_data("plot_data_with_slopes.csv")
         plot_slopes_for_plots(df, plot_ids=tuple(plot_ids_to_viz), outdir="figures")
     
     # Generate phenology classification visualizations
@@ -1,6 +1,10 @@
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import folium
-from folium import plugins
+import mapbuild
+from mapbuild import stage_names
 
 # Configuration
 TARGET_DATES = [
@@ -13,114 +17,43 @@ TARGET_DATES = [
 ]
 COORDINATES_FILE = "figures/new-coordinates.xlsx"
 OUTPUT_DIR = "phenology_maps"
+DATA_FILE = "plot_data_with_slopes.csv"  # or its .parquet twin, see mapbuild.plot_data_path
 
-import os
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-print(f"Creating phenology classification maps for {len(TARGET_DATES)} dates...")
-print(f"Using coordinates from: {COORDINATES_FILE}")
-
-# Load new coordinates from Excel
-try:
-    coords_df = pd.read_excel(COORDINATES_FILE)
-    print(f"Loaded Excel file with shape: {coords_df.shape}")
-    
-    # The Excel file has 4 columns, each containing "lat, lon" pairs
-    # Let's rename them for clarity
-    coords_df.columns = ['coordinate1', 'coordinate2', 'coordinate3', 'coordinate4']
-    
-    # Add plot_id as row number (starting from 1)
-    coords_df['plot_id'] = range(1, len(coords_df) + 1)
-    
-    print(f"Loaded coordinates for {len(coords_df)} plots")
-except FileNotFoundError:
-    print(f"Error: '{COORDINATES_FILE}' not found!")
-    exit(1)
-
-# Load plot data with classifications
-try:
-    data_df = pd.read_csv("plot_data_with_slopes.csv")
-    # Convert date to datetime
-    data_df['date'] = pd.to_datetime(data_df['date'])
-    print(f"Loaded classification data: {len(data_df)} rows")
-except FileNotFoundError:
-    print("Error: 'plot_data_with_slopes.csv' not found!")
-    print("Please run laddu.py first to generate the classification data.")
-    exit(1)
-
-# Parse coordinates - note: format is "lat, lon" (reversed from typical lon,lat)
-def parse_coord(coord_str):
-    """Parse 'lat, lon' string into (lon, lat) tuple - note the order swap!"""
-    try:
-        parts = str(coord_str).strip().split(',')
-        lat = float(parts[0].strip())
-        lon = float(parts[1].strip())
-        return lon, lat  # Return as (lon, lat) for consistency
-    except:
-        return None, None
-
-# Calculate centroid from all 4 coordinates for each plot
-def calculate_centroid(row):
-    """Calculate the centroid (center) of the field from all 4 corner coordinates"""
-    lons = []
-    lats = []
-    for col in ['coordinate1', 'coordinate2', 'coordinate3', 'coordinate4']:
-        if col in row and pd.notna(row[col]):
-            lon, lat = parse_coord(row[col])
-            if lon is not None and lat is not None:
-                lons.append(lon)
-                lats.append(lat)
-    
-    if lons and lats:
-        return pd.Series({'lon': sum(lons) / len(lons), 'lat': sum(lats) / len(lats)})
-    else:
-        return pd.Series({'lon': None, 'lat': None})
-
-# Calculate centroids
-coords_df[['lon', 'lat']] = coords_df.apply(calculate_centroid, axis=1)
-coords_df = coords_df.dropna(subset=['lon', 'lat'])
 
-print(f"Calculated centroids for {len(coords_df)} plots")
-print(f"Coordinate range: Lat {coords_df['lat'].min():.6f} to {coords_df['lat'].max():.6f}")
-print(f"                  Lon {coords_df['lon'].min():.6f} to {coords_df['lon'].max():.6f}")
+# Placeholders in the rendered map shell, filled in per date
+MAP_NAME_SLOT = "__MAP_NAME__"
+LEGEND_SLOT = "__LEGEND__"
 
-# Define phenology stage colors (used in all maps)
-stage_colors = {
-    0: '#D3D3D3',      # Bare - light gray
-    1: '#90EE90',      # Seedling - light green
-    2: '#FFD700',      # Tillering - gold
-    3: '#228B22',      # Growth - forest green
-    4: '#FF8C00'       # Ripening - dark orange
-}
 
-stage_names = {
-    0: 'Bare',
-    1: 'Seedling',
-    2: 'Tillering',
-    3: 'Growth',
-    4: 'Ripening'
-}
+def build_map_shell(plot_coords):
+    """
+    Render the parts of the map that are the same for every date (tiles, controls, marker
+    callbacks) once; the per-date map name and legend are left as placeholders.
+    """
+    # Every date shows every plot, so the map is centred on all of them
+    m = mapbuild.make_base_map(plot_coords[['lat', 'lon']].to_numpy().mean(axis=0))
+    
+    # Markers are read from the per-date data/ scripts: colored by stage WITH classification
+    # data, gray WITHOUT
+    cluster = len(plot_coords) > mapbuild.CLUSTER_THRESHOLD
+    mapbuild.add_plot_layer(m, f'PLOT_DATA["{MAP_NAME_SLOT}"]', f"data/{MAP_NAME_SLOT}.js", cluster,
+                            radius=12, color='black', fill_opacity=0.8, max_width=300)
+    mapbuild.add_plot_layer(m, f'PLOT_DATA["{MAP_NAME_SLOT}_no_data"]', f"data/{MAP_NAME_SLOT}_no_data.js", cluster,
+                            name='Plots without data', radius=10, color='gray', fill_opacity=0.5, max_width=250,
+                            label_class='plot-label no-data')
+    
+    m.get_root().html.add_child(folium.Element(LEGEND_SLOT))
+    mapbuild.add_map_controls(m)
+    return m.get_root().render()
 
-# Loop through all target dates
-print(f"\n{'='*60}")
-print(f"Generating maps for {len(TARGET_DATES)} dates")
-print(f"{'='*60}\n")
 
-for date_idx, TARGET_DATE in enumerate(TARGET_DATES, 1):
-    print(f"\n[{date_idx}/{len(TARGET_DATES)}] Processing date: {TARGET_DATE}")
-    
-    # Filter data to target date
-    target_df = data_df[data_df['date'] == TARGET_DATE].copy()
-
-    if target_df.empty:
-        print(f"  ⚠ Warning: No data found for date {TARGET_DATE}, skipping...")
-        continue
-    
+def build_map_for_date(TARGET_DATE, plot_coords, target_df, shell_html):
+    """Write the map for one date from the shared shell; returns the progress lines to print (runs in a worker process)"""
     # Get one observation per plot (take first if multiple)
-    target_df = target_df.groupby('plot_id').first().reset_index()
+    target_df = target_df.drop_duplicates(subset='plot_id', keep='first')
     
     # Merge coordinates with classification data
-    map_data = coords_df.merge(
+    map_data = plot_coords.merge(
         target_df[['plot_id', 'stage4_code', 'stage_4', 'NDVI', 'SAVI', 'NDWI']], 
         on='plot_id', 
         how='left'
@@ -130,169 +63,143 @@ for date_idx, TARGET_DATE in enumerate(TARGET_DATES, 1):
     plots_with_data = map_data.dropna(subset=['stage4_code'])
     plots_without_data = map_data[map_data['stage4_code'].isna()]
     
-    print(f"  Plots with data: {len(plots_with_data)}, without data: {len(plots_without_data)}")
-    
-    # Calculate center of all plots for map initialization
-    all_plots = pd.concat([plots_with_data, plots_without_data])
-    center_lat = all_plots['lat'].mean()
-    center_lon = all_plots['lon'].mean()
-    
-    # Create folium map with satellite imagery
-    m = folium.Map(
-        location=[center_lat, center_lon],
-        zoom_start=15,
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri World Imagery'
-    )
-    
-    # Add alternative tile layers
-    folium.TileLayer('OpenStreetMap', name='Street Map').add_to(m)
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Satellite',
-        overlay=False,
-        control=True
-    ).add_to(m)
-    
-    # Add markers for plots WITH classification data
-    for _, row in plots_with_data.iterrows():
-        stage = int(row['stage4_code'])
-        color = stage_colors.get(stage, '#808080')
-        stage_name = stage_names.get(stage, 'Unknown')
-        
-        # Create popup with detailed information
-        popup_html = f"""
-        <div style="font-family: Arial; min-width: 200px;">
-            <h4 style="margin: 5px 0; color: #333;">Plot #{int(row['plot_id'])}</h4>
-            <hr style="margin: 5px 0;">
-            <b>Date:</b> {TARGET_DATE}<br>
-            <b>Phenology Stage:</b> <span style="color: {color}; font-weight: bold;">{stage_name}</span> (Stage {stage})<br>
-            <hr style="margin: 5px 0;">
-            <b>Vegetation Indices:</b><br>
-            • NDVI: {row['NDVI']:.4f}<br>
-            • SAVI: {row['SAVI']:.4f}<br>
-            • NDWI: {row['NDWI']:.4f}<br>
-            <hr style="margin: 5px 0;">
-            <small>Lat: {row['lat']:.6f}, Lon: {row['lon']:.6f}</small>
-        </div>
-        """
-        
-        # Create circle marker with phenology color
-        folium.CircleMarker(
-            location=[row['lat'], row['lon']],
-            radius=12,
-            popup=folium.Popup(popup_html, max_width=300),
-            tooltip=f"Plot {int(row['plot_id'])}: {stage_name}",
-            color='black',
-            weight=2,
-            fill=True,
-            fillColor=color,
-            fillOpacity=0.8
-        ).add_to(m)
-        
-        # Add plot number as a label
-        folium.Marker(
-            location=[row['lat'], row['lon']],
-            icon=folium.DivIcon(
-                html=f'''<div style="
-                    font-size: 10px; 
-                    font-weight: bold; 
-                    color: black;
-                    text-align: center;
-                    text-shadow: 1px 1px 2px white, -1px -1px 2px white;
-                    ">{int(row['plot_id'])}</div>'''
-            )
-        ).add_to(m)
-    
-    # Add markers for plots WITHOUT classification data (gray markers)
-    for _, row in plots_without_data.iterrows():
-        popup_html = f"""
-        <div style="font-family: Arial; min-width: 200px;">
-            <h4 style="margin: 5px 0; color: #333;">Plot #{int(row['plot_id'])}</h4>
-            <hr style="margin: 5px 0;">
-            <b>Status:</b> <span style="color: red;">No classification data</span><br>
-            <hr style="margin: 5px 0;">
-            <small>Lat: {row['lat']:.6f}, Lon: {row['lon']:.6f}</small>
-        </div>
-        """
-        
-        folium.CircleMarker(
-            location=[row['lat'], row['lon']],
-            radius=10,
-            popup=folium.Popup(popup_html, max_width=250),
-            tooltip=f"Plot {int(row['plot_id'])}: No data",
-            color='gray',
-            weight=2,
-            fill=True,
-            fillColor='lightgray',
-            fillOpacity=0.5
-        ).add_to(m)
+    log = [f"  Plots with data: {len(plots_with_data)}, without data: {len(plots_without_data)}"]
+    
+    # Popups for all plots at once: colored by stage WITH classification data, gray WITHOUT
+    plots_with_data = mapbuild.with_stage_columns(plots_with_data)
+    plots_with_data['popup_html'] = mapbuild.stage_popup_html(plots_with_data, TARGET_DATE)
+    plots_without_data = plots_without_data.assign(popup_html=mapbuild.no_data_popup_html(plots_without_data))
+    
+    # The marker data goes to data/ next to the map; the shell's script tags load it by map name
+    map_name = f"map_{TARGET_DATE.replace('-', '_')}"
+    data_scripts = {
+        f"{OUTPUT_DIR}/data/{map_name}.js":
+            mapbuild.rows_script(mapbuild.plot_rows(plots_with_data, color_col='color'), map_name),
+        f"{OUTPUT_DIR}/data/{map_name}_no_data.js":
+            mapbuild.rows_script(mapbuild.plot_rows(plots_without_data, fill_color='lightgray'), f"{map_name}_no_data"),
+    }
+    legend_html = mapbuild.stage_legend_html(TARGET_DATE, 'With data', f"{len(plots_with_data)}/{len(map_data)}", no_data=True)
+    OUTPUT_FILE = f"{OUTPUT_DIR}/{map_name}.html"
+    
+    # Leave the files alone when this date's markers and legend, and the code that lays out
+    # the shell, are the same as on the run that last wrote them
+    digest = hashlib.blake2b(
+        "".join([*data_scripts.values(), legend_html,
+                 str(os.path.getmtime(__file__)), str(os.path.getmtime(mapbuild.__file__))]).encode(),
+        digest_size=16
+    ).hexdigest()
+    hash_file = OUTPUT_FILE + '.hash'
+    unchanged = False
+    if all(os.path.exists(path) for path in [OUTPUT_FILE, hash_file, *data_scripts]):
+        with open(hash_file) as f:
+            unchanged = f.read() == digest
+    
+    if unchanged:
+        log.append(f"  ✅ Map unchanged: {OUTPUT_FILE}")
+    else:
+        for data_file, script in data_scripts.items():
+            os.makedirs(os.path.dirname(data_file), exist_ok=True)
+            with open(data_file, 'w', encoding='utf-8') as f:
+                f.write(script)
         
-        folium.Marker(
-            location=[row['lat'], row['lon']],
-            icon=folium.DivIcon(
-                html=f'''<div style="
-                    font-size: 10px; 
-                    font-weight: bold; 
-                    color: gray;
-                    text-align: center;
-                    text-shadow: 1px 1px 2px white, -1px -1px 2px white;
-                    ">{int(row['plot_id'])}</div>'''
-            )
-        ).add_to(m)
-    
-    # Add custom legend
-    legend_html = f'''
-    <div style="position: fixed; 
-                top: 10px; right: 10px; width: 220px; 
-                background-color: white; 
-                border:2px solid grey; z-index:9999; 
-                font-size:14px;
-                padding: 10px;
-                border-radius: 5px;
-                box-shadow: 2px 2px 6px rgba(0,0,0,0.3);">
-        <h4 style="margin-top:0; margin-bottom:10px; text-align:center;">Phenology Stages</h4>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[0]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 0: Bare</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[1]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 1: Seedling</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[2]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 2: Tillering</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[3]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 3: Growth</p>
-        <p style="margin: 5px 0;"><span style="background-color: {stage_colors[4]}; border: 1px solid black; padding: 3px 8px; border-radius: 3px;">⬤</span> 4: Ripening</p>
-        <p style="margin: 5px 0;"><span style="background-color: lightgray; border: 1px solid gray; padding: 3px 8px; border-radius: 3px;">⬤</span> No data</p>
-        <hr style="margin: 10px 0;">
-        <p style="margin: 5px 0; font-size: 12px; text-align: center;"><b>Date:</b> {TARGET_DATE}</p>
-        <p style="margin: 5px 0; font-size: 12px; text-align: center;"><b>With data:</b> {len(plots_with_data)}/{len(all_plots)}</p>
-    </div>
-    '''
-    m.get_root().html.add_child(folium.Element(legend_html))
-    
-    # Add layer control
-    folium.LayerControl().add_to(m)
-    
-    # Add fullscreen button
-    plugins.Fullscreen(
-        position='topleft',
-        title='Enter fullscreen mode',
-        title_cancel='Exit fullscreen mode',
-        force_separate_button=True
-    ).add_to(m)
-    
-    # Add measure control for distance measurements
-    plugins.MeasureControl(position='bottomleft', primary_length_unit='meters').add_to(m)
-    
-    # Save map as HTML
-    OUTPUT_FILE = f"{OUTPUT_DIR}/map_{TARGET_DATE.replace('-', '_')}.html"
-    m.save(OUTPUT_FILE)
-    
-    print(f"  ✅ Map saved: {OUTPUT_FILE}")
+        # Fill in this date's legend and data scripts, then save map as HTML
+        html = shell_html.replace(MAP_NAME_SLOT, map_name).replace(LEGEND_SLOT, legend_html)
+        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
+            f.write(html)
+        with open(hash_file, 'w') as f:
+            f.write(digest)
+        log.append(f"  ✅ Map saved: {OUTPUT_FILE}")
     if len(plots_with_data) > 0:
         stage_breakdown = plots_with_data['stage4_code'].value_counts().sort_index()
         breakdown_str = ", ".join([f"{stage_names[int(k)]}: {v}" for k, v in stage_breakdown.items()])
-        print(f"     {breakdown_str}")
+        log.append(f"     {breakdown_str}")
+    return log
+
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    print(f"Creating phenology classification maps for {len(TARGET_DATES)} dates...")
+    print(f"Using coordinates from: {COORDINATES_FILE}")
+
+    # Load new coordinates from Excel (parsed once, then reused from a Parquet cache)
+    try:
+        coords_df = mapbuild.load_coords_cached(COORDINATES_FILE)
+        print(f"Loaded Excel file with shape: {coords_df.shape}")
+
+        # The Excel file has 4 columns, each containing "lat, lon" pairs
+        # Let's rename them for clarity
+        coords_df.columns = ['coordinate1', 'coordinate2', 'coordinate3', 'coordinate4']
+
+        # Add plot_id as row number (starting from 1)
+        coords_df['plot_id'] = range(1, len(coords_df) + 1)
+
+        print(f"Loaded coordinates for {len(coords_df)} plots")
+    except FileNotFoundError:
+        print(f"Error: '{COORDINATES_FILE}' not found!")
+        exit(1)
+
+    # Load plot data with classifications
+    try:
+        data_file = mapbuild.plot_data_path(DATA_FILE)
+        data_df = mapbuild.read_plot_data(data_file)
+        print(f"Loaded classification data: {len(data_df)} rows")
+    except FileNotFoundError:
+        print(f"Error: '{data_file}' (or its .parquet twin) not found!")
+        print("Please run laddu.py first to generate the classification data.")
+        exit(1)
+
+    # Only plots that appear in the classification data can be mapped; drop the rest up front
+    valid_ids = set(data_df['plot_id'].unique())
+    coords_df = coords_df[coords_df['plot_id'].isin(valid_ids)].copy()
+
+    # Calculate centroids - note: format is "lat, lon" (reversed from typical lon,lat)
+    coords_df[['lon', 'lat']] = mapbuild.calculate_centroids(coords_df, order='lat,lon')
+    coords_df = coords_df.dropna(subset=['lon', 'lat'])
+
+    print(f"Calculated centroids for {len(coords_df)} plots")
+    coord_range = coords_df[['lat', 'lon']].agg(['min', 'max'])
+    print(f"Coordinate range: Lat {coord_range.loc['min', 'lat']:.6f} to {coord_range.loc['max', 'lat']:.6f}")
+    print(f"                  Lon {coord_range.loc['min', 'lon']:.6f} to {coord_range.loc['max', 'lon']:.6f}")
+
+    # Split the data by date once, grouping on categorical codes for the target dates only
+    # (rows from other dates fall outside the categories and are dropped), and keep only
+    # the columns the maps need from the coordinates
+    target_timestamps = pd.to_datetime(TARGET_DATES)
+    date_codes = pd.Categorical(data_df['date'], categories=target_timestamps)
+    by_date = {d: g for d, g in data_df.groupby(date_codes, observed=True)}
+    plot_coords = coords_df[['plot_id', 'lon', 'lat']]
+
+    # Render everything that does not change between dates once
+    shell_html = build_map_shell(plot_coords)
+
+    print(f"\n{'='*60}")
+    print(f"Generating maps for {len(TARGET_DATES)} dates")
+    print(f"{'='*60}\n")
+
+    # Build the maps in parallel, one date per worker task; progress is printed in date order
+    futures = {}
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for TARGET_DATE, target_ts in zip(TARGET_DATES, target_timestamps):
+            # Look up the rows for the target date
+            target_df = by_date.get(target_ts)
+            if target_df is not None:
+                futures[TARGET_DATE] = executor.submit(build_map_for_date, TARGET_DATE, plot_coords, target_df, shell_html)
+
+        for date_idx, TARGET_DATE in enumerate(TARGET_DATES, 1):
+            print(f"\n[{date_idx}/{len(TARGET_DATES)}] Processing date: {TARGET_DATE}")
+            if TARGET_DATE not in futures:
+                print(f"  ⚠ Warning: No data found for date {TARGET_DATE}, skipping...")
+                continue
+            print("\n".join(futures[TARGET_DATE].result()))
+
+    # Final summary
+    print(f"\n{'='*60}")
+    print(f"✅ All maps generated successfully!")
+    print(f"Total maps created: {len(TARGET_DATES)}")
+    print(f"Output directory: {OUTPUT_DIR}")
+    print(f"{'='*60}")
+
 
-# Final summary
-print(f"\n{'='*60}")
-print(f"✅ All maps generated successfully!")
-print(f"Total maps created: {len(TARGET_DATES)}")
-print(f"Output directory: {OUTPUT_DIR}")
-print(f"{'='*60}")
+if __name__ == "__main__":
+    main()
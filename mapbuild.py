@@ -0,0 +1,374 @@
+"""Shared building blocks for the folium plot maps (loading, base map, markers, caching)."""
+import os
+import glob
+import json
+import shutil
+import string
+import hashlib
+import pandas as pd
+import folium
+from folium import plugins
+from jinja2 import Template
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; without it the marker data is serialized with the json module
+    orjson = None
+
+COORD_COLS = ['coordinate1', 'coordinate2', 'coordinate3', 'coordinate4']
+# First two comma-separated fields of a corner string, whitespace trimmed
+COORD_PAIR_RE = r'^\s*([^,]*?)\s*,\s*([^,]*?)\s*(?:,|$)'
+ESRI_TILES = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
+CLUSTER_THRESHOLD = 500  # Above this many plots, markers are clustered in the browser
+CACHE_DIR = ".cache"
+
+# Define phenology stage colors
+stage_colors = {
+    0: '#D3D3D3',      # Bare - light gray
+    1: '#90EE90',      # Seedling - light green
+    2: '#FFD700',      # Tillering - gold
+    3: '#228B22',      # Growth - forest green
+    4: '#FF8C00'       # Ripening - dark orange
+}
+
+stage_names = {
+    0: 'Bare',
+    1: 'Seedling',
+    2: 'Tillering',
+    3: 'Growth',
+    4: 'Ripening'
+}
+
+# Stage legend, built once; stage_legend_html() only fills in the per-map date and count
+LEGEND_TEMPLATE = string.Template('''
+<div style="position: fixed; 
+            top: 10px; right: 10px; width: 220px; 
+            background-color: white; 
+            border:2px solid grey; z-index:9999; 
+            font-size:14px;
+            padding: 10px;
+            border-radius: 5px;
+            box-shadow: 2px 2px 6px rgba(0,0,0,0.3);">
+    <h4 style="margin-top:0; margin-bottom:10px; text-align:center;">Phenology Stages</h4>
+$stage_rows
+    <hr style="margin: 10px 0;">
+    <p style="margin: 5px 0; font-size: 12px; text-align: center;"><b>Date:</b> $date</p>
+    <p style="margin: 5px 0; font-size: 12px; text-align: center;"><b>$count_label:</b> $count</p>
+</div>
+''')
+
+LEGEND_STAGE_ROWS = "\n".join(
+    f'    <p style="margin: 5px 0;"><span style="background-color: {stage_colors[code]}; border: 1px solid black; '
+    f'padding: 3px 8px; border-radius: 3px;">⬤</span> {code}: {stage_names[code]}</p>'
+    for code in sorted(stage_names)
+)
+LEGEND_NO_DATA_ROW = (
+    '    <p style="margin: 5px 0;"><span style="background-color: lightgray; border: 1px solid gray; '
+    'padding: 3px 8px; border-radius: 3px;">⬤</span> No data</p>'
+)
+
+# Plot numbers are drawn as permanent tooltips on the circle markers
+PLOT_LABEL_CSS = '''
+<style>
+    .plot-label {
+        background: transparent;
+        border: none;
+        box-shadow: none;
+        font: bold 10px Arial;
+        color: black;
+        text-shadow: 1px 1px 2px white, -1px -1px 2px white;
+    }
+    .plot-label::before { display: none; }
+    .plot-label.no-data { color: gray; }
+</style>
+'''
+
+
+def calculate_centroids(df, order='lon,lat'):
+    """Average the 4 corner strings of every plot, one column at a time ('lon,lat' or 'lat, lon' order)"""
+    lon_part, lat_part = (1, 0) if order.replace(' ', '') == 'lat,lon' else (0, 1)
+    corner_lons = []
+    corner_lats = []
+    for col in COORD_COLS:
+        if col not in df:
+            continue
+        parts = df[col].astype(str).str.extract(COORD_PAIR_RE)
+        lon = pd.to_numeric(parts[lon_part], errors='coerce')
+        lat = pd.to_numeric(parts[lat_part], errors='coerce')
+        valid = lon.notna() & lat.notna()
+        corner_lons.append(lon.where(valid))
+        corner_lats.append(lat.where(valid))
+    return pd.DataFrame({
+        'lon': pd.concat(corner_lons, axis=1).mean(axis=1),
+        'lat': pd.concat(corner_lats, axis=1).mean(axis=1),
+    })
+
+
+def load_centroids(csv_path):
+    """Load plot corner coordinates and return one row per plot with its lon/lat centroid"""
+    coords_df = pd.read_csv(csv_path)
+    plot_coords = coords_df.drop_duplicates(subset='plot_id', keep='first').copy()
+    plot_coords[['lon', 'lat']] = calculate_centroids(plot_coords)
+    return plot_coords.dropna(subset=['lon', 'lat'])
+
+
+def load_coords_cached(xlsx_path):
+    """Read the coordinates workbook, reusing a Parquet copy while the .xlsx is unchanged"""
+    # Keyed on the full path so same-named workbooks in different folders get their own copy
+    key = hashlib.sha1(os.path.abspath(xlsx_path).encode()).hexdigest()[:16]
+    cache = os.path.join(CACHE_DIR, f"{os.path.basename(xlsx_path)}.{key}.parquet")
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(xlsx_path):
+        try:
+            return pd.read_parquet(cache)
+        except Exception:
+            pass  # pyarrow missing or a damaged file; parse the workbook again
+    df = pd.read_excel(xlsx_path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(cache)
+    except Exception:
+        pass  # caching is optional
+    return df
+
+
+def plot_data_path(csv_path):
+    """The classified plot data file to read: the Parquet twin of csv_path (OUTPUT_FORMAT=parquet) when it is at least as new"""
+    parquet_path = os.path.splitext(csv_path)[0] + '.parquet'
+    if os.path.exists(parquet_path) and (
+            not os.path.exists(csv_path) or os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)):
+        return parquet_path
+    return csv_path
+
+
+def read_plot_data(csv_path):
+    """Read the classified plot data (see plot_data_path) with a parsed date column (pyarrow engine when available)"""
+    data_path = plot_data_path(csv_path)
+    if data_path.endswith('.parquet'):
+        return pd.read_parquet(data_path)
+    try:
+        return pd.read_csv(data_path, engine='pyarrow', parse_dates=['date'])
+    except (ImportError, ValueError):
+        data_df = pd.read_csv(data_path)
+        data_df['date'] = pd.to_datetime(data_df['date'])
+        return data_df
+
+
+class CanvasRenderer(folium.MacroElement):
+    """One shared L.canvas renderer (JS global plot_canvas) that all plot markers draw onto"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var plot_canvas = L.canvas({padding: {{ this.padding }}});
+        {% endmacro %}
+    """)
+
+    def __init__(self, padding=0.5):
+        super().__init__()
+        self._name = 'CanvasRenderer'
+        self.padding = padding
+
+
+def make_base_map(center, prefer_canvas=True):
+    """Satellite base map with a street-map alternative, centred on (lat, lon)"""
+    m = folium.Map(
+        location=list(center),
+        zoom_start=15,
+        tiles=ESRI_TILES,
+        attr='Esri World Imagery',
+        prefer_canvas=prefer_canvas
+    )
+
+    # Add alternative tile layers
+    folium.TileLayer('OpenStreetMap', name='Street Map').add_to(m)
+    folium.TileLayer(
+        tiles=ESRI_TILES,
+        attr='Esri',
+        name='Satellite',
+        overlay=False,
+        control=True
+    ).add_to(m)
+
+    m.get_root().header.add_child(folium.Element(PLOT_LABEL_CSS))
+    # Added before any markers so its script runs first
+    CanvasRenderer().add_to(m)
+    return m
+
+
+def add_map_controls(m):
+    """Layer control, fullscreen button and distance measurement (add after all layers)"""
+    folium.LayerControl().add_to(m)
+
+    plugins.Fullscreen(
+        position='topleft',
+        title='Enter fullscreen mode',
+        title_cancel='Exit fullscreen mode',
+        force_separate_button=True
+    ).add_to(m)
+
+    plugins.MeasureControl(position='bottomleft', primary_length_unit='meters').add_to(m)
+
+
+def plot_marker_js(radius=12, color='black', fill_opacity=0.8, max_width=300, label_class='plot-label'):
+    """Leaflet callback turning one [lat, lon, fill, popup, plot_id] row into a labelled circle marker (drawn on plot_canvas)"""
+    return f'''function (row) {{
+    return L.circleMarker([row[0], row[1]], {{
+        renderer: plot_canvas, radius: {radius}, color: '{color}', weight: 2,
+        fill: true, fillColor: row[2], fillOpacity: {fill_opacity}
+    }}).bindPopup(row[3], {{maxWidth: {max_width}}})
+      .bindTooltip(String(row[4]), {{permanent: true, direction: 'center', className: '{label_class}'}});
+}}'''
+
+
+class PlotMarkers(folium.MacroElement):
+    """Add all plot markers from one JSON array (inline, or a JS expression such as a sidecar global) in one batch"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function () {
+                var makeMarker = {{ this.callback }};
+                var rows = {% if this.rows_js %}{{ this.rows_js }}{% else %}{{ this.rows|tojson }}{% endif %};
+                var markers = rows.map(function (row) { return makeMarker(row); });
+                var layer = {{ this._parent.get_name() }};
+                // Marker clusters take the whole batch at once; other layers one marker at a time
+                if (layer.addLayers) {
+                    layer.addLayers(markers);
+                } else {
+                    markers.forEach(function (marker) { layer.addLayer(marker); });
+                }
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, rows, callback, rows_js=None):
+        super().__init__()
+        self._name = 'PlotMarkers'
+        self.rows = rows
+        self.callback = callback
+        self.rows_js = rows_js
+
+
+def rows_script(rows, key):
+    """JS source that registers marker rows as PLOT_DATA[key]"""
+    if orjson is not None:
+        payload = orjson.dumps(rows, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    else:
+        payload = json.dumps(rows, separators=(',', ':'))
+    return f'(window.PLOT_DATA = window.PLOT_DATA || {{}})[{json.dumps(key)}] = {payload};\n'
+
+
+def plot_rows(df, color_col=None, fill_color='lightblue'):
+    """[lat, lon, fill, popup_html, plot_id] marker rows for df; fill from df[color_col] when given, else fill_color"""
+    return df[['lat', 'lon']].assign(
+        fill=df[color_col] if color_col else fill_color,
+        popup_html=df['popup_html'],
+        plot_id=df['plot_id'].astype(int)
+    ).values.tolist()
+
+
+def plot_layer(m, name, cluster=False):
+    """One named overlay holding a whole batch of plot markers (a marker cluster when cluster is set)"""
+    layer = plugins.MarkerCluster(name=name) if cluster else folium.FeatureGroup(name=name)
+    return layer.add_to(m)
+
+
+def add_plot_layer(m, rows_js, data_src=None, cluster=False, name='Plots', **style):
+    """
+    Add markers for the rows a JS expression evaluates to (e.g. PLOT_DATA[key] from a sidecar
+    loaded via <script src=data_src>). style goes to plot_marker_js; cluster groups them in the browser.
+    """
+    if data_src:
+        # A script tag (not fetch) so the map still works when opened from disk
+        m.get_root().header.add_child(folium.JavascriptLink(data_src))
+    PlotMarkers([], plot_marker_js(**style), rows_js).add_to(plot_layer(m, name, cluster))
+
+
+def add_plots_canvas(m, df, color_col=None, fill_color='lightblue', name='Plots', **style):
+    """
+    Add one circle marker per row of df (needs lat, lon, popup_html, plot_id) to a make_base_map map.
+    Fill comes from df[color_col] when given, else fill_color; style goes to plot_marker_js.
+    """
+    # Cluster in the browser when there are too many plots to show individually
+    cluster = len(df) > CLUSTER_THRESHOLD
+    PlotMarkers(plot_rows(df, color_col, fill_color), plot_marker_js(**style)).add_to(plot_layer(m, name, cluster))
+
+
+def stage_legend_html(date, count_label, count, no_data=False):
+    """Fixed-position stage legend for one map (no_data adds the gray 'No data' entry)"""
+    stage_rows = LEGEND_STAGE_ROWS + ('\n' + LEGEND_NO_DATA_ROW if no_data else '')
+    return LEGEND_TEMPLATE.substitute(stage_rows=stage_rows, date=date, count_label=count_label, count=count)
+
+
+def with_stage_columns(df):
+    """Copy of df with color and stage_name columns looked up from stage4_code in one pass"""
+    stage_codes = df['stage4_code'].astype(int)
+    return df.assign(color=stage_codes.map(stage_colors).fillna('#808080'),
+                     stage_name=stage_codes.map(stage_names).fillna('Unknown'))
+
+
+def stage_popup_html(df, date):
+    """Popup HTML for every classified plot in df (needs plot_id, stage4_code, color, stage_name, indices, lat, lon)"""
+    return (
+        '<div style="font-family: Arial; min-width: 200px;">'
+        '<h4 style="margin: 5px 0; color: #333;">Plot #' + df['plot_id'].astype(int).astype(str) + '</h4>'
+        '<hr style="margin: 5px 0;">'
+        f'<b>Date:</b> {date}<br>'
+        '<b>Phenology Stage:</b> <span style="color: ' + df['color'] + '; font-weight: bold;">'
+        + df['stage_name'] + '</span> (Stage ' + df['stage4_code'].astype(int).astype(str) + ')<br>'
+        '<hr style="margin: 5px 0;">'
+        '<b>Vegetation Indices:</b><br>'
+        '• NDVI: ' + df['NDVI'].map('{:.4f}'.format) + '<br>'
+        '• SAVI: ' + df['SAVI'].map('{:.4f}'.format) + '<br>'
+        '• NDWI: ' + df['NDWI'].map('{:.4f}'.format) + '<br>'
+        '<hr style="margin: 5px 0;">'
+        '<small>Lat: ' + df['lat'].map('{:.6f}'.format) + ', Lon: ' + df['lon'].map('{:.6f}'.format) + '</small>'
+        '</div>'
+    )
+
+
+def no_data_popup_html(df):
+    """Popup HTML for plots that have no classification on the mapped date"""
+    return (
+        '<div style="font-family: Arial; min-width: 200px;">'
+        '<h4 style="margin: 5px 0; color: #333;">Plot #' + df['plot_id'].astype(int).astype(str) + '</h4>'
+        '<hr style="margin: 5px 0;">'
+        '<b>Status:</b> <span style="color: red;">No classification data</span><br>'
+        '<hr style="margin: 5px 0;">'
+        '<small>Lat: ' + df['lat'].map('{:.6f}'.format) + ', Lon: ' + df['lon'].map('{:.6f}'.format) + '</small>'
+        '</div>'
+    )
+
+
+def cache_prefix(output_file):
+    """Name prefix shared by every cache entry for output_file (basename plus a short hash of its full path)"""
+    path_key = hashlib.sha1(os.path.abspath(output_file).encode()).hexdigest()[:8]
+    return f"{os.path.basename(output_file)}.{path_key}."
+
+
+def map_cache_path(output_file, inputs, *key_parts):
+    """Cache file for output_file built from these input files and settings (None if an input is missing)"""
+    inputs = [*inputs, __file__]
+    if not all(os.path.exists(path) for path in inputs):
+        return None
+    key = hashlib.sha1(
+        ("".join(map(str, key_parts)) + "".join(str(os.path.getmtime(path)) for path in inputs)).encode()
+    ).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"{cache_prefix(output_file)}{key}.html")
+
+
+def restore_cached_map(cache_file, output_file):
+    """Copy a previously built map into place; returns False when there is nothing cached"""
+    if not cache_file or not os.path.exists(cache_file):
+        return False
+    shutil.copyfile(cache_file, output_file)
+    return True
+
+
+def save_map(m, output_file, cache_file=None):
+    """Save the map as HTML and keep a copy under cache_file for later runs, replacing older copies"""
+    m.save(output_file)
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        shutil.copyfile(output_file, cache_file)
+        # Entries for earlier inputs or settings of this output can never be hit again
+        for old_file in glob.glob(os.path.join(CACHE_DIR, glob.escape(cache_prefix(output_file)) + '*.html')):
+            if old_file != cache_file:
+                os.remove(old_file)